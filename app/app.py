@@ -1,16 +1,31 @@
 from jnpr.junos import Device
 from lxml import etree
 import re
-from cgi import escape, parse_qs
+from html import escape
+from urllib.parse import parse_qs
 import json
 import yaml
 import logging
+import cProfile
+import io
+import pstats
+import tempfile
+import threading
+import time
+import bisect
+import fcntl
+import os
+import hashlib
+import itertools
 
 
 logger = logging.getLogger(__name__)
 
 config = None
 
+# top level config sections that are not modules
+RESERVED_SECTIONS = ('sharding', 'admission')
+
 
 class Metrics(object):
     """
@@ -70,6 +85,34 @@ class Metrics(object):
         return "\n".join([str(x) for x in lines]) + '\n'
 
 
+class HashRing(object):
+    """
+    Consistent hash ring used to assign targets to exporter replicas
+    """
+
+    def __init__(self, nodes, virtual_nodes=100):
+        self._ring = []
+        for node in nodes:
+            for i in range(virtual_nodes):
+                self._ring.append((self._hash('{}-{}'.format(node, i)), node))
+        self._ring.sort()
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """
+        Get the node that owns a key
+        """
+        if not self._ring:
+            raise ValueError('Hash ring has no nodes.')
+
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
 def hello(environ, start_response):
     """Like the example above, but it uses the name specified in the
 URL."""
@@ -91,6 +134,12 @@ def not_found(environ, start_response):
     return [bytes('Not Found', 'utf-8')]
 
 
+def module_not_found(start_response, module):
+    """Called if the requested module is a reserved config section."""
+    start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+    return [bytes('{} is not a module'.format(module), 'utf-8')]
+
+
 def get_interface_metrics(registry, dev):
     """
     Get interface metrics
@@ -499,27 +548,27 @@ def get_storage_metrics(registry, dev):
             registry.add_metric('fileSystemBlocksUsed', used_blocks, {'fpc': fpc, 'filesystem': filesystem_name, 'mountpoint': mount_point})
 
 
-def get_bgp_metrics(registry, dev):
-    """
-    Get BGP neighbor metrics
-    """
+# Based on the order in which states are defined in the
+# BGP FSA in RFC4271 section 8.2.2
+_bgp_peer_state_values = {
+    'NoState': 0,
+    'Idle': 1,
+    'Connect': 2,
+    'Active': 3,
+    'OpenSent': 4,
+    'OpenConfirm': 5,
+    'Established': 6
+}
 
-    # Based on the order in which states are defined in the
-    # BGP FSA in RFC4271 section 8.2.2
-    _peer_state_values = {
-        'NoState': 0,
-        'Idle': 1,
-        'Connect': 2,
-        'Active': 3,
-        'OpenSent': 4,
-        'OpenConfirm': 5,
-        'Established': 6
-    }
+# default directory of the per target bgp neighbor detail cache of the tiered bgp collection
+_bgp_cache_dir = os.path.join(tempfile.gettempdir(), 'junos_exporter', 'bgp')
 
-    # bgp neighbor data
-    bgp_results = dev.rpc.get_bgp_neighbor_information()
 
-    # register bgp metrics
+def _register_bgp_metrics(registry):
+    """
+    Register BGP neighbor metrics
+    """
+
     registry.register('bgpPeerCount', 'gauge')
     registry.register('bgpPeerState', 'gauge')
     registry.register('bgpPeerLastState', 'gauge')
@@ -545,171 +594,679 @@ def get_bgp_metrics(registry, dev):
     registry.register('bgpErrorSendCount', 'gauge')
     registry.register('bgpErrorReceiveCount', 'gauge')
 
-    peers = bgp_results.findall('bgp-peer')
-    registry.add_metric('bgpPeerCount', len(peers))
 
-    for peer in peers:
+def _bgp_peer_key(peer):
+    """
+    Peer address without the port, which neighbor detail includes for established sessions
+    """
+
+    return peer.find('peer-address').text.strip().split('+')[0]
+
+
+def _find(element, path):
+    """
+    Find a sub element of an element that may be missing
+    """
+
+    if element is None:
+        return None
+    return element.find(path)
+
 
-        peer_address = peer.find('peer-address').text
-        peer_as = peer.find('peer-as').text
-        local_address = peer.find('local-address').text
-        local_as = peer.find('local-as').text
+def _fresh_element(path, detail, summary=None):
+    """
+    Prefer the element from the bgp summary if there is one, else fall back to the neighbor detail
+    """
+
+    element = _find(summary, path)
+    if element is not None:
+        return element
+    return _find(detail, path)
+
+
+def _add_bgp_peer_metrics(registry, peer, summary_peer=None):
+    """
+    Add the metrics of a single BGP peer from its neighbor detail. If the peer
+    from the bgp summary is given, the values it contains (state, flap count,
+    prefix counts, message counts) take precedence over the detail, and the
+    detail may be None, in which case only the summary values are added.
+    """
+
+    if peer is not None:
+        meta = {
+            'peerAddress': peer.find('peer-address').text,
+            'localAddress': peer.find('local-address').text,
+            'peerAS': peer.find('peer-as').text,
+            'localAS': peer.find('local-as').text
+        }
+    else:
+        # the summary has no local address and AS
         meta = {
-            'peerAddress': peer_address,
-            'localAddress': local_address,
-            'peerAS': peer_as,
-            'localAS': local_as 
+            'peerAddress': summary_peer.find('peer-address').text,
+            'peerAS': summary_peer.find('peer-as').text
         }
 
-        peer_state_text = peer.find('peer-state').text
-        peer_state = _peer_state_values[peer_state_text]
+    # state metrics
+    peer_state_text = _fresh_element('peer-state', peer, summary_peer).text
+    peer_state = _bgp_peer_state_values[peer_state_text]
+    if peer is not None:
         last_state_text = peer.find('last-state').text
-        last_state = _peer_state_values[last_state_text]
-
-        # state metrics
+        last_state = _bgp_peer_state_values[last_state_text]
         registry.add_metric('bgpPeerState', peer_state, {**meta, **{'state': peer_state_text,'lastState': last_state_text}})
         registry.add_metric('bgpPeerLastState', last_state, {**meta, **{'lastState': last_state_text, 'state': peer_state_text}})
+    else:
+        registry.add_metric('bgpPeerState', peer_state, {**meta, **{'state': peer_state_text}})
+
+    # holdtime option
+    hold_time = _find(peer, 'bgp-option-information/holdtime')
+    if hold_time is not None:
+        registry.add_metric('bgpPeerOptionHoldtime', hold_time.text, meta)
+
+    # preference option
+    preference = _find(peer, 'bgp-option-information/preference')
+    if preference is not None:
+        registry.add_metric('bgpPeerOptionPreference', preference.text, meta)
+
+    # flap counts
+    flap_count = _fresh_element('flap-count', peer, summary_peer)
+    last_flap_event = _find(peer, 'last-flap-event')
+    if flap_count is not None:
+        if last_flap_event is not None:
+            registry.add_metric('bgpPeerFlapCount', flap_count.text, {**meta, **{'lastFlapEvent': last_flap_event.text}})
+        else:
+            registry.add_metric('bgpPeerFlapCount', flap_count.text, meta)
+
+    # rib metrics, the summary only lacks the advertised prefix count
+    detail_ribs = {}
+    if peer is not None:
+        detail_ribs = {rib.find('name').text: rib for rib in peer.findall('bgp-rib')}
+    if summary_peer is not None:
+        ribs = summary_peer.findall('bgp-rib')
+    else:
+        ribs = peer.findall('bgp-rib')
+    for rib in ribs:
 
-        # holdtime option
-        hold_time = peer.find('bgp-option-information/holdtime')
-        if hold_time is not None:
-            registry.add_metric('bgpPeerOptionHoldtime', hold_time.text, meta)
-
-        # preference option
-        preference = peer.find('bgp-option-information/preference')
-        if preference is not None:
-            registry.add_metric('bgpPeerOptionPreference', preference.text, meta)
-
-        # flap counts
-        flap_count = peer.find('flap-count')
-        last_flap_event = peer.find('last-flap-event')
-        if flap_count is not None:
-            if last_flap_event is not None:
-                registry.add_metric('bgpPeerFlapCount', flap_count.text, {**meta, **{'lastFlapEvent': last_flap_event.text}})
-            else:
-                registry.add_metric('bgpPeerFlapCount', flap_count.text, meta)
+        rib_name = rib.find('name').text
+        rib_meta = {'ribName': rib_name}
+        rib_meta = {**rib_meta, **meta}
 
-        # rib metrics
-        for rib in peer.findall('bgp-rib'):
+        active_prefix_count = rib.find('active-prefix-count').text
+        received_prefix_count = rib.find('received-prefix-count').text
+        accepted_prefix_count = rib.find('accepted-prefix-count').text
+        suppressed_prefix_count = rib.find('suppressed-prefix-count').text
+        advertised_prefix_count = _find(detail_ribs.get(rib_name), 'advertised-prefix-count')
 
-            rib_name = rib.find('name').text
-            rib_meta = {'ribName': rib_name}
-            rib_meta = {**rib_meta, **meta}
+        registry.add_metric('bgpPeerActivePrefixCount', active_prefix_count, rib_meta)
+        registry.add_metric('bgpPeerReceivedPrefixCount', received_prefix_count, rib_meta)
+        registry.add_metric('bgpPeerAcceptedPrefixCount', accepted_prefix_count, rib_meta)
+        registry.add_metric('bgpPeerSuppressedPrefixCount', suppressed_prefix_count, rib_meta)
+        if advertised_prefix_count is not None:
+            registry.add_metric('bgpPeerAdvertisedPrefixCount', advertised_prefix_count.text, rib_meta)
 
-            active_prefix_count = rib.find('active-prefix-count').text
-            received_prefix_count = rib.find('received-prefix-count').text
-            accepted_prefix_count = rib.find('accepted-prefix-count').text
-            suppressed_prefix_count = rib.find('suppressed-prefix-count').text
-            advertised_prefix_count = rib.find('advertised-prefix-count').text
+    # stats
+    last_received = _find(peer, 'last-received')
+    if last_received is not None:
+        registry.add_metric('bgpPeerLastReceived', last_received.text, meta)
 
-            registry.add_metric('bgpPeerActivePrefixCount', active_prefix_count, rib_meta)
-            registry.add_metric('bgpPeerReceivedPrefixCount', received_prefix_count, rib_meta)
-            registry.add_metric('bgpPeerAcceptedPrefixCount', accepted_prefix_count, rib_meta)
-            registry.add_metric('bgpPeerSuppressedPrefixCount', suppressed_prefix_count, rib_meta)
-            registry.add_metric('bgpPeerAdvertisedPrefixCount', advertised_prefix_count, rib_meta)
+    last_sent = _find(peer, 'last-sent')
+    if last_sent is not None:
+        registry.add_metric('bgpPeerLastSent', last_sent.text, meta)
 
-        # stats
-        last_received = peer.find('last-received')
-        if last_received is not None:
-            registry.add_metric('bgpPeerLastReceived', last_received.text, meta)
+    last_checked = _find(peer, 'last-checked')
+    if last_checked is not None:
+        registry.add_metric('bgpPeerLastChecked', last_checked.text, meta)
 
-        last_sent = peer.find('last-sent')
-        if last_sent is not None:
-            registry.add_metric('bgpPeerLastSent', last_sent.text, meta)
+    input_messages = _fresh_element('input-messages', peer, summary_peer)
+    if input_messages is not None:
+        registry.add_metric('bgpPeerInputMessages', input_messages.text, meta)
 
-        last_checked = peer.find('last-checked')
-        if last_checked is not None:
-            registry.add_metric('bgpPeerLastChecked', last_checked.text, meta)
+    input_updates = _find(peer, 'input-updates')
+    if input_updates is not None:
+        registry.add_metric('bgpPeerInputUpdates', input_updates.text, meta)
 
-        input_messages = peer.find('input-messages')
-        if input_messages is not None:
-            registry.add_metric('bgpPeerInputMessages', input_messages.text, meta)
+    input_refreshes = _find(peer, 'input-refreshes')
+    if input_refreshes is not None:
+        registry.add_metric('bgpPeerInputRefreshes', input_refreshes.text, meta)
 
-        input_updates = peer.find('input-updates')
-        if input_updates is not None:
-            registry.add_metric('bgpPeerInputUpdates', input_updates.text, meta)
+    input_octets = _find(peer, 'input-octets')
+    if input_octets is not None:
+        registry.add_metric('bgpPeerInputOctets', input_octets.text, meta)
 
-        input_refreshes = peer.find('input-refreshes')
-        if input_refreshes is not None:
-            registry.add_metric('bgpPeerInputRefreshes', input_refreshes.text, meta)
+    output_messages = _fresh_element('output-messages', peer, summary_peer)
+    if output_messages is not None:
+        registry.add_metric('bgpPeerOutputMessages', output_messages.text, meta)
 
-        input_octets = peer.find('input-octets')
-        if input_octets is not None:
-            registry.add_metric('bgpPeerInputOctets', input_octets.text, meta)
+    output_updates = _find(peer, 'output-updates')
+    if output_updates is not None:
+        registry.add_metric('bgpPeerOutputUpdates', output_updates.text, meta)
 
-        output_messages = peer.find('output-messages')
-        if output_messages is not None:
-            registry.add_metric('bgpPeerOutputMessages', output_messages.text, meta)
+    output_refreshes = _find(peer, 'output-refreshes')
+    if output_refreshes is not None:
+        registry.add_metric('bgpPeerOutputRefreshes', output_refreshes.text, meta)
 
-        output_updates = peer.find('output-updates')
-        if output_updates is not None:
-            registry.add_metric('bgpPeerOutputUpdates', output_updates.text, meta)
+    output_octets = _find(peer, 'output-octets')
+    if output_octets is not None:
+        registry.add_metric('bgpPeerOutputOctets', output_octets.text, meta)
 
-        output_refreshes = peer.find('output-refreshes')
-        if output_refreshes is not None:
-            registry.add_metric('bgpPeerOutputRefreshes', output_refreshes.text, meta)
+    # errors
+    if peer is None:
+        return
+    for error in peer.findall('bgp-error'):
 
-        output_octets = peer.find('output-octets')
-        if output_octets is not None:
-            registry.add_metric('bgpPeerOutputOctets', output_octets.text, meta)
+        error_name = error.find('name').text
+        error_meta = {'errorName': error_name}
+        error_meta = {**error_meta, **meta}
 
-        # errors
-        for error in peer.findall('bgp-error'):
+        send_count = error.find('send-count').text
+        receive_count = error.find('receive-count').text
 
-            error_name = error.find('name').text
-            error_meta = {'errorName': error_name}
-            error_meta = {**error_meta, **meta}
+        registry.add_metric('bgpErrorSendCount', send_count, error_meta)
+        registry.add_metric('bgpErrorReceiveCount', receive_count, error_meta)
 
-            send_count = error.find('send-count').text
-            receive_count = error.find('receive-count').text
 
-            registry.add_metric('bgpErrorSendCount', send_count, error_meta)
-            registry.add_metric('bgpErrorReceiveCount', receive_count, error_meta)
+def get_bgp_metrics(registry, dev):
+    """
+    Get BGP neighbor metrics
+    """
 
+    # bgp neighbor data
+    bgp_results = dev.rpc.get_bgp_neighbor_information()
 
-def metrics(environ, start_response):
+    # register bgp metrics
+    _register_bgp_metrics(registry)
+
+    peers = bgp_results.findall('bgp-peer')
+    registry.add_metric('bgpPeerCount', len(peers))
+
+    for peer in peers:
+        _add_bgp_peer_metrics(registry, peer)
+
+
+def _bgp_cache_path(options, target):
+    """
+    Path of the bgp neighbor detail cache file of a target
+    """
+
+    cache_dir = options.get('cache_dir', _bgp_cache_dir)
+    return os.path.join(cache_dir, '{}.json'.format(hashlib.sha1(target.encode('utf-8')).hexdigest()))
+
+
+def _load_bgp_detail_cache(path):
+    """
+    Load the cached bgp neighbor detail of a target, None if there is none
+    """
+
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {
+        'time': cache['time'],
+        'peers': {peer_key: etree.fromstring(peer) for peer_key, peer in cache['peers'].items()}
+    }
+
+
+def _save_bgp_detail_cache(path, cache):
+    """
+    Atomically write the bgp neighbor detail cache of a target so all workers can use it
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+        json.dump({
+            'time': cache['time'],
+            'peers': {peer_key: etree.tostring(peer).decode('utf-8') for peer_key, peer in cache['peers'].items()}
+        }, f)
+    os.replace(f.name, path)
+
+
+def _get_bgp_detail(dev, **kwargs):
+    """
+    Get bgp neighbor detail keyed by peer address
+    """
+
+    bgp_results = dev.rpc.get_bgp_neighbor_information(**kwargs)
+    return {_bgp_peer_key(peer): peer for peer in bgp_results.findall('bgp-peer')}
+
+
+def _refresh_bgp_detail(profile, target, cache_path, lock_file):
+    """
+    Fetch the full bgp neighbor detail of a target over its own device
+    connection and cache it. Runs in the background, holding the refresh lock
+    of the target, and waits for a scrape slot with the lowest priority.
+    """
+
+    try:
+        config = load_config()
+        slot = admission.acquire(target, float('-inf'), config.get('admission', {}))
+        try:
+            dev = open_device(profile, target)
+            try:
+                cache = {'time': time.time(), 'peers': _get_bgp_detail(dev)}
+            finally:
+                dev.close()
+        finally:
+            admission.release(slot)
+        _save_bgp_detail_cache(cache_path, cache)
+    except Exception:
+        logger.exception('Unable to refresh the BGP neighbor detail of %s', target)
+    finally:
+        _unlock(lock_file)
+
+
+def _start_bgp_detail_refresh(profile, target, cache_path):
+    """
+    Start a background refresh of the bgp neighbor detail of a target, unless
+    a worker is already refreshing it
+    """
+
+    lock_file = _try_lock(cache_path + '.lock')
+    if lock_file is None:
+        return
+    try:
+        thread = threading.Thread(target=_refresh_bgp_detail, args=(profile, target, cache_path, lock_file))
+        thread.daemon = True
+        thread.start()
+    except Exception:
+        _unlock(lock_file)
+        raise
+
+
+def get_bgp_tiered_metrics(registry, dev, target, profile):
+    """
+    Get BGP neighbor metrics using the bgp summary on every scrape. Full
+    neighbor detail is cached on disk for all workers and refreshed in the
+    background every `detail_interval` seconds, while scrapes keep using the
+    cached detail. Peers selected by `detail_peers` and `detail_groups`, new
+    peers and peers whose state changed since the detail was fetched get
+    fresh detail during the scrape, one rpc per peer up to `detail_max_peers`.
+    Past that, a background refresh is started instead.
+    """
+
+    options = profile.get('bgp', {})
+    detail_interval = options.get('detail_interval', 300)
+    detail_peers = options.get('detail_peers', [])
+    detail_groups = options.get('detail_groups', [])
+    detail_max_peers = options.get('detail_max_peers', 20)
+
+    # bgp summary data
+    summary_results = dev.rpc.get_bgp_summary_information()
+    summary_peers = summary_results.findall('bgp-peer')
+
+    # bgp neighbor data
+    cache_path = _bgp_cache_path(options, target)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    cache = _load_bgp_detail_cache(cache_path)
+    if cache is None:
+        # never fetched, make sure the background refresh runs
+        cache = {'time': 0, 'peers': {}}
+
+    # selected peers, new peers and peers that changed state get fresh detail
+    refresh = set(detail_peers)
+    for peer_key, peer in cache['peers'].items():
+        peer_group = peer.find('peer-group')
+        if peer_group is not None and peer_group.text.strip() in detail_groups:
+            refresh.add(peer_key)
+    for summary_peer in summary_peers:
+        peer_key = _bgp_peer_key(summary_peer)
+        peer = cache['peers'].get(peer_key)
+        if peer is None or peer.find('peer-state').text != summary_peer.find('peer-state').text:
+            refresh.add(peer_key)
+
+    if time.time() - cache['time'] >= detail_interval or len(refresh) > detail_max_peers:
+        # a full fetch is slow, keep it out of the scrape
+        _start_bgp_detail_refresh(profile, target, cache_path)
+
+    if refresh and len(refresh) <= detail_max_peers:
+        fresh_peers = {}
+        for peer_key in refresh:
+            fresh_peers.update(_get_bgp_detail(dev, neighbor_address=peer_key))
+        cache['peers'].update(fresh_peers)
+
+        # a background refresh may have saved newer detail in the meantime
+        latest = _load_bgp_detail_cache(cache_path) or cache
+        latest['peers'].update(fresh_peers)
+        _save_bgp_detail_cache(cache_path, latest)
+
+    # register bgp metrics
+    _register_bgp_metrics(registry)
+
+    registry.add_metric('bgpPeerCount', len(summary_peers))
+
+    for summary_peer in summary_peers:
+        peer = cache['peers'].get(_bgp_peer_key(summary_peer))
+        _add_bgp_peer_metrics(registry, peer, summary_peer)
+
+
+def load_config():
+    """
+    Load the exporter config file
+    """
 
-    # load config
     with open('junos_exporter.yaml', 'r') as f:
-        config = yaml.load(f)
+        return yaml.safe_load(f)
 
-    # parameters from url
-    parameters = parse_qs(environ.get('QUERY_STRING', ''))
 
-    # get profile from config
-    profile = config[parameters['module'][0]]
+def open_device(profile, target):
+    """
+    Open a device connection using the auth settings of a module
+    """
 
-    # open device connection
     if profile['auth']['method'] == 'password':
         # using regular username/password
-        dev = Device(host=parameters['target'][0],
+        dev = Device(host=target,
                      user=profile['auth']['username'],
                      password=profile['auth']['password'])
     elif profile['auth']['method'] == 'ssh_key':
         # using ssh key
-        dev = Device(host=parameters['target'][0],
+        dev = Device(host=target,
                      user=profile['auth']['username'],
                      password=profile['auth'].get('password'),
                      ssh_private_key_file='./ssh_private_key_file')
     dev.open()
+    return dev
 
-    # create metrics registry
-    registry = Metrics()
 
-    # get and parse metrics
+def _untimed(name, func, *args):
+    """
+    Default collector runner, just calls the collector
+    """
+
+    return func(*args)
+
+
+def collect_metrics(registry, dev, profile, target, run=_untimed):
+    """
+    Run every collector enabled for the module against the device.
+    `run` is called as run(name, collector, *args) for each collector.
+    """
+
     types = profile['metrics']
     if 'interface' in types:
-        get_interface_metrics(registry, dev)
+        run('interface', get_interface_metrics, registry, dev)
     if 'environment' in types:
-        get_environment_metrics(registry, dev)
+        run('environment', get_environment_metrics, registry, dev)
     if 'virtual_chassis' in types:
-        get_virtual_chassis_metrics(registry, dev)
+        run('virtual_chassis', get_virtual_chassis_metrics, registry, dev)
     if 'routing_engine' in types:
-        get_route_engine_metrics(registry, dev)
+        run('routing_engine', get_route_engine_metrics, registry, dev)
     if 'storage' in types:
-        get_storage_metrics(registry, dev)
+        run('storage', get_storage_metrics, registry, dev)
     if 'bgp' in types:
-        get_bgp_metrics(registry, dev)
+        bgp_options = profile.get('bgp', {})
+        if bgp_options.get('mode') == 'tiered':
+            run('bgp', get_bgp_tiered_metrics, registry, dev, target, profile)
+        else:
+            run('bgp', get_bgp_metrics, registry, dev)
+
+
+def _try_lock(path):
+    """
+    Take an exclusive lock on a file without blocking. Returns the open lock
+    file, or None if another process holds the lock.
+    """
+
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _unlock(lock_file):
+    """
+    Release a lock taken with `_try_lock`
+    """
+
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+# default directory of the scrape slot lock files shared by all workers
+_admission_lock_dir = os.path.join(tempfile.gettempdir(), 'junos_exporter', 'admission')
+
+
+class AdmissionError(Exception):
+    """
+    Raised when a scrape can not be admitted
+    """
+
+
+class AdmissionController(object):
+    """
+    Limit concurrent scrapes, globally and per target. Scrapes that can not
+    run right away wait in a bounded queue in the worker, highest priority
+    first. Once admitted in the worker, a scrape also takes a slot lock file
+    so the limits hold across all workers.
+    """
+
+    class _Slot(object):
+        """
+        An admitted scrape
+        """
+
+        def __init__(self, target, lock_files, wait_time):
+            self.target = target
+            self.lock_files = lock_files
+            self.wait_time = wait_time
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._active = 0
+        self._active_targets = {}
+        self._waiting = []
+        self._evicted = set()
+        self.rejected = 0
+
+    def _has_capacity(self, target, settings):
+        max_concurrent = settings.get('max_concurrent')
+        max_concurrent_per_target = settings.get('max_concurrent_per_target')
+        if max_concurrent is not None and self._active >= max_concurrent:
+            return False
+        if max_concurrent_per_target is not None and self._active_targets.get(target, 0) >= max_concurrent_per_target:
+            return False
+        return True
+
+    def _next_waiter(self, settings):
+        """
+        The highest priority waiter whose target has capacity
+        """
+        for waiter in sorted(self._waiting):
+            if self._has_capacity(waiter[2], settings):
+                return waiter
+        return None
+
+    def _lock_slots(self, target, settings, deadline):
+        """
+        Take a slot lock file for the target and a global one, polling until
+        the deadline while other workers hold all of them
+        """
+        limits = []
+        if settings.get('max_concurrent_per_target') is not None:
+            limits.append((hashlib.sha1(target.encode('utf-8')).hexdigest(), settings['max_concurrent_per_target']))
+        if settings.get('max_concurrent') is not None:
+            limits.append(('global', settings['max_concurrent']))
+        if not limits:
+            return []
+
+        lock_dir = settings.get('lock_dir', _admission_lock_dir)
+        while True:
+            lock_files = []
+            try:
+                os.makedirs(lock_dir, exist_ok=True)
+                for name, limit in limits:
+                    for i in range(limit):
+                        lock_file = _try_lock(os.path.join(lock_dir, '{}.{}.lock'.format(name, i)))
+                        if lock_file is not None:
+                            lock_files.append(lock_file)
+                            break
+                    else:
+                        break
+            except OSError as e:
+                for lock_file in lock_files:
+                    _unlock(lock_file)
+                logger.error('Unable to use the scrape slot lock directory %s: %s', lock_dir, e)
+                raise AdmissionError('Unable to use the scrape slot lock directory')
+
+            if len(lock_files) == len(limits):
+                return lock_files
+
+            for lock_file in lock_files:
+                _unlock(lock_file)
+            if time.monotonic() >= deadline:
+                raise AdmissionError('Timed out waiting for a scrape slot held by another worker')
+            time.sleep(0.1)
+
+    def acquire(self, target, priority, settings):
+        """
+        Wait for a scrape slot for the target
+        """
+        start = time.monotonic()
+        deadline = start + settings.get('queue_timeout', 30)
+        waiter = (-priority, next(self._sequence), target)
+
+        with self._condition:
+            self._waiting.append(waiter)
+            if self._next_waiter(settings) is not waiter and len(self._waiting) > settings.get('max_queue', 10):
+                # make room by rejecting the lowest priority waiter, which may be us
+                lowest = max(self._waiting)
+                self._waiting.remove(lowest)
+                self.rejected += 1
+                if lowest is waiter:
+                    raise AdmissionError('Scrape queue is full')
+                self._evicted.add(lowest)
+                self._condition.notify_all()
+
+            while True:
+                if waiter in self._evicted:
+                    self._evicted.remove(waiter)
+                    raise AdmissionError('Evicted from the scrape queue by a higher priority scrape')
+                if self._next_waiter(settings) is waiter:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(waiter)
+                    self.rejected += 1
+                    # our slot may now be usable by someone else
+                    self._condition.notify_all()
+                    raise AdmissionError('Timed out waiting in the scrape queue')
+                self._condition.wait(remaining)
+
+            self._waiting.remove(waiter)
+            self._active += 1
+            self._active_targets[target] = self._active_targets.get(target, 0) + 1
+            # waiters behind us may have capacity for their own target
+            self._condition.notify_all()
+
+        try:
+            lock_files = self._lock_slots(target, settings, deadline)
+        except Exception as e:
+            self._release_target(target)
+            if isinstance(e, AdmissionError):
+                with self._condition:
+                    self.rejected += 1
+            raise
+
+        return self._Slot(target, lock_files, time.monotonic() - start)
+
+    def _release_target(self, target):
+        with self._condition:
+            self._active -= 1
+            self._active_targets[target] -= 1
+            if self._active_targets[target] == 0:
+                del self._active_targets[target]
+            self._condition.notify_all()
+
+    def release(self, slot):
+        """
+        Give back a scrape slot
+        """
+        for lock_file in slot.lock_files:
+            _unlock(lock_file)
+        self._release_target(slot.target)
+
+    def add_metrics(self, registry, slot):
+        """
+        Add the admission metrics of this worker and the wait time of the current scrape
+        """
+        registry.register('scrapeQueueWaitSeconds', 'gauge')
+        registry.register('scrapeQueueDepth', 'gauge')
+        registry.register('scrapeActive', 'gauge')
+        registry.register('scrapeRejected', 'counter')
+
+        with self._condition:
+            registry.add_metric('scrapeQueueWaitSeconds', slot.wait_time)
+            registry.add_metric('scrapeQueueDepth', len(self._waiting))
+            registry.add_metric('scrapeActive', self._active)
+            registry.add_metric('scrapeRejected', self.rejected)
+
+
+# scrape admission of this worker
+admission = AdmissionController()
+
+
+def scrape_priority(environ, profile):
+    """
+    Priority of a scrape, taken from the X-Scrape-Priority header or else the
+    module. Higher priority scrapes leave the queue first.
+    """
+
+    priority = environ.get('HTTP_X_SCRAPE_PRIORITY')
+    if priority is not None:
+        try:
+            return int(priority)
+        except ValueError:
+            pass
+    return profile.get('priority', 0)
+
+
+def queue_full(start_response, error):
+    """Called if a scrape is not admitted."""
+    start_response('503 SERVICE UNAVAILABLE', [('Content-Type', 'text/plain')])
+    return [bytes(str(error), 'utf-8')]
+
+
+def metrics(environ, start_response):
+
+    # load config
+    config = load_config()
+
+    # parameters from url
+    parameters = parse_qs(environ.get('QUERY_STRING', ''))
+
+    # get profile from config
+    module = parameters['module'][0]
+    if module in RESERVED_SECTIONS:
+        return module_not_found(start_response, module)
+    profile = config[module]
+
+    # wait for a scrape slot
+    target = parameters['target'][0]
+    try:
+        slot = admission.acquire(target, scrape_priority(environ, profile), config.get('admission', {}))
+    except AdmissionError as e:
+        return queue_full(start_response, e)
+
+    try:
+        # open device connection
+        dev = open_device(profile, target)
+
+        try:
+            # create metrics registry
+            registry = Metrics()
+
+            # get and parse metrics
+            collect_metrics(registry, dev, profile, target)
+        finally:
+            dev.close()
+    finally:
+        admission.release(slot)
+
+    admission.add_metrics(registry, slot)
 
     # start response
     data = registry.collect()
@@ -722,10 +1279,333 @@ def metrics(environ, start_response):
     return [bytes(data, 'utf-8')]
 
 
+class ScrapeProfile(object):
+    """
+    Wall and CPU timings of the phases of a single scrape
+    """
+
+    class _Phase(object):
+        """
+        Context manager timing one phase
+        """
+
+        def __init__(self, scrape_profile, name):
+            self.scrape_profile = scrape_profile
+            self.name = name
+
+        def __enter__(self):
+            self.wall = time.perf_counter()
+            self.cpu = time.process_time()
+            return self
+
+        def __exit__(self, *exc):
+            self.scrape_profile.phases.append({
+                'name': self.name,
+                'wall': time.perf_counter() - self.wall,
+                'cpu': time.process_time() - self.cpu
+            })
+
+    class _RPC(object):
+        """
+        Proxy for `dev.rpc` that times each rpc and records the reply size
+        """
+
+        def __init__(self, scrape_profile, rpc):
+            self._scrape_profile = scrape_profile
+            self._rpc = rpc
+
+        def __getattr__(self, rpc_name):
+            rpc_method = getattr(self._rpc, rpc_name)
+
+            def timed_rpc(*args, **kwargs):
+                with self._scrape_profile.phase('rpc:{}'.format(rpc_name)):
+                    result = rpc_method(*args, **kwargs)
+
+                # measuring the reply is profiling overhead, keep it out of the parse phase
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                self._scrape_profile.payloads.append({
+                    'rpc': rpc_name,
+                    'bytes': len(etree.tostring(result))
+                })
+                self._scrape_profile.overhead_wall += time.perf_counter() - wall
+                self._scrape_profile.overhead_cpu += time.process_time() - cpu
+                return result
+
+            return timed_rpc
+
+    class _Device(object):
+        """
+        Device proxy handed to the collectors while profiling
+        """
+
+        def __init__(self, scrape_profile, dev):
+            self.rpc = ScrapeProfile._RPC(scrape_profile, dev.rpc)
+
+    class _Registry(object):
+        """
+        Proxy for the metrics registry that times the register and add_metric calls
+        """
+
+        def __init__(self, scrape_profile, registry):
+            self._scrape_profile = scrape_profile
+            self._registry = registry
+
+        def _timed(self, func, *args):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            func(*args)
+            self._scrape_profile.registry_wall += time.perf_counter() - wall
+            self._scrape_profile.registry_cpu += time.process_time() - cpu
+
+        def register(self, name, metric_type):
+            self._timed(self._registry.register, name, metric_type)
+
+        def add_metric(self, name, value, labels=None):
+            self._timed(self._registry.add_metric, name, value, labels)
+
+        def collect(self):
+            return self._registry.collect()
+
+    def __init__(self):
+        self.phases = []
+        self.payloads = []
+        self.registry_wall = 0.0
+        self.registry_cpu = 0.0
+        self.overhead_wall = 0.0
+        self.overhead_cpu = 0.0
+
+    def phase(self, name):
+        """
+        Time a phase of the scrape
+        """
+        return self._Phase(self, name)
+
+    def device(self, dev):
+        """
+        Wrap a device so its rpc's are timed
+        """
+        return self._Device(self, dev)
+
+    def registry(self, registry):
+        """
+        Wrap a metrics registry so its calls are timed
+        """
+        return self._Registry(self, registry)
+
+    def run(self, name, func, *args):
+        """
+        Collector runner for `collect_metrics`. Time spent in the registry is
+        recorded as the registry phase of the collector, the rest of the time
+        spent outside of rpc's and the profiler itself as its parse phase.
+        """
+        first_phase = len(self.phases)
+        self.registry_wall = 0.0
+        self.registry_cpu = 0.0
+        self.overhead_wall = 0.0
+        self.overhead_cpu = 0.0
+        with self.phase('collect:{}'.format(name)):
+            func(*args)
+        rpc_phases = self.phases[first_phase:-1]
+        collect_phase = self.phases.pop()
+        self.phases.append({
+            'name': 'parse:{}'.format(name),
+            'wall': collect_phase['wall'] - sum(p['wall'] for p in rpc_phases) - self.registry_wall - self.overhead_wall,
+            'cpu': collect_phase['cpu'] - sum(p['cpu'] for p in rpc_phases) - self.registry_cpu - self.overhead_cpu
+        })
+        self.phases.append({
+            'name': 'registry:{}'.format(name),
+            'wall': self.registry_wall,
+            'cpu': self.registry_cpu
+        })
+
+
+# only one profiled scrape at a time across all workers
+_profile_lock_path = os.path.join(tempfile.gettempdir(), 'junos_exporter_profile.lock')
+
+
+def profile_scrape(environ, start_response):
+    """
+    Run a single scrape under cProfile and return per phase timings, rpc
+    reply sizes and the profile. With `format=pstats` the raw pstats dump is
+    returned instead, which can be loaded by tools like snakeviz or flameprof.
+    """
+
+    # load config
+    config = load_config()
+
+    # parameters from url
+    parameters = parse_qs(environ.get('QUERY_STRING', ''))
+
+    # get profile from config
+    module = parameters['module'][0]
+    if module in RESERVED_SECTIONS:
+        return module_not_found(start_response, module)
+    profile = config[module]
+    if not profile.get('debug_profile', False):
+        start_response('403 FORBIDDEN', [('Content-Type', 'text/plain')])
+        return [bytes('Profiling is not enabled for this module', 'utf-8')]
+
+    profile_lock = _try_lock(_profile_lock_path)
+    if profile_lock is None:
+        start_response('429 TOO MANY REQUESTS', [('Content-Type', 'text/plain')])
+        return [bytes('A profiled scrape is already running', 'utf-8')]
+
+    try:
+        # wait for a scrape slot
+        target = parameters['target'][0]
+        try:
+            slot = admission.acquire(target, scrape_priority(environ, profile), config.get('admission', {}))
+        except AdmissionError as e:
+            return queue_full(start_response, e)
+
+        scrape_profile = ScrapeProfile()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            # open device connection
+            with scrape_profile.phase('connect'):
+                dev = open_device(profile, target)
+
+            try:
+                # create metrics registry
+                registry = scrape_profile.registry(Metrics())
+
+                # get and parse metrics
+                collect_metrics(registry, scrape_profile.device(dev), profile, target, run=scrape_profile.run)
+
+                # render
+                with scrape_profile.phase('render'):
+                    data = registry.collect()
+            finally:
+                dev.close()
+        finally:
+            profiler.disable()
+            admission.release(slot)
+    finally:
+        _unlock(profile_lock)
+
+    output_format = parameters.get('format', ['json'])[0]
+    if output_format == 'pstats':
+        with tempfile.NamedTemporaryFile() as f:
+            profiler.dump_stats(f.name)
+            body = f.read()
+        content_type = 'application/octet-stream'
+    else:
+        stats_output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_output)
+        stats.sort_stats('cumulative').print_stats(50)
+        body = bytes(json.dumps({
+            'target': target,
+            'phases': scrape_profile.phases,
+            'payloads': scrape_profile.payloads,
+            'responseBytes': len(data),
+            'profile': stats_output.getvalue()
+        }, indent=2), 'utf-8')
+        content_type = 'application/json'
+
+    response_headers = [
+        ('Content-type', content_type),
+        ('Content-Length', str(len(body)))
+    ]
+    start_response('200 OK', response_headers)
+    return [body]
+
+
+def _load_list(path):
+    """
+    Load a yaml list from a file
+    """
+
+    with open(path, 'r') as f:
+        items = yaml.safe_load(f) or []
+    if not isinstance(items, list):
+        raise ValueError('{} does not contain a list'.format(path))
+    return items
+
+
+def get_replicas(config):
+    """
+    Get the exporter replica addresses from the sharding config
+    """
+
+    sharding = config.get('sharding', {})
+    replicas = list(sharding.get('replicas', []))
+    if sharding.get('replicas_file'):
+        replicas.extend(_load_list(sharding['replicas_file']))
+    return replicas
+
+
+def get_targets(profile):
+    """
+    Get the target inventory of a module
+    """
+
+    targets = list(profile.get('targets', []))
+    if profile.get('targets_file'):
+        targets.extend(_load_list(profile['targets_file']))
+    return targets
+
+
+def service_discovery(environ, start_response):
+    """
+    Prometheus HTTP service discovery. Every target in the inventory is
+    returned with the address of the replica that owns it on the hash ring.
+    """
+
+    # load config
+    config = load_config()
+
+    # parameters from url
+    parameters = parse_qs(environ.get('QUERY_STRING', ''))
+    modules = parameters.get('module')
+
+    try:
+        replicas = get_replicas(config)
+    except (OSError, ValueError) as e:
+        replicas = []
+        logger.error('Unable to load replicas file: %s', e)
+    if not replicas:
+        logger.error('Service discovery requested but no replicas are configured')
+        start_response('503 SERVICE UNAVAILABLE', [('Content-Type', 'text/plain')])
+        return [bytes('No replicas are configured', 'utf-8')]
+
+    ring = HashRing(replicas, config.get('sharding', {}).get('virtual_nodes', 100))
+
+    target_groups = []
+    for module, profile in config.items():
+        if module in RESERVED_SECTIONS or (modules and module not in modules):
+            continue
+        try:
+            targets = get_targets(profile)
+        except (OSError, ValueError) as e:
+            logger.error('Unable to load targets file of module %s: %s', module, e)
+            continue
+        for target in targets:
+            target_groups.append({
+                'targets': [ring.get_node(target)],
+                'labels': {
+                    '__param_module': module,
+                    '__param_target': target,
+                    'instance': target
+                }
+            })
+
+    data = json.dumps(target_groups)
+    response_headers = [
+        ('Content-type', 'application/json'),
+        ('Content-Length', str(len(data)))
+    ]
+    start_response('200 OK', response_headers)
+    return [bytes(data, 'utf-8')]
+
+
 # map urls to functions
 urls = [
     #(r'metrics$', self_service),
     #(r'metrics/$', self_service),
+    (r'debug/profile/?$', profile_scrape),
+    (r'sd/?$', service_discovery),
     (r'metrics/?$', metrics),
     (r'metrics/(.+)$', metrics)
 ]
@@ -0,0 +1,199 @@
+import fcntl
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from app import AdmissionController, AdmissionError, HashRing  # noqa: E402
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
+
+
+class Scrape(threading.Thread):
+    """
+    Acquire a scrape slot in the background and record the outcome
+    """
+
+    def __init__(self, controller, target, priority, settings):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.target = target
+        self.priority = priority
+        self.settings = settings
+        self.slot = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.slot = self.controller.acquire(self.target, self.priority, self.settings)
+        except AdmissionError as e:
+            self.error = e
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return {
+        'max_concurrent': 1,
+        'max_concurrent_per_target': 1,
+        'max_queue': 1,
+        'queue_timeout': 2,
+        'lock_dir': str(tmp_path / 'locks')
+    }
+
+
+def test_hash_ring_without_nodes():
+    with pytest.raises(ValueError):
+        HashRing([]).get_node('router1')
+
+
+def test_hash_ring_ignores_node_order():
+    ring = HashRing(['a:9665', 'b:9665', 'c:9665'])
+    reversed_ring = HashRing(['c:9665', 'b:9665', 'a:9665'])
+    for i in range(200):
+        target = 'router{}'.format(i)
+        assert ring.get_node(target) == reversed_ring.get_node(target)
+
+
+def test_hash_ring_spreads_targets():
+    ring = HashRing(['a:9665', 'b:9665', 'c:9665'])
+    nodes = [ring.get_node('router{}'.format(i)) for i in range(300)]
+    for node in ('a:9665', 'b:9665', 'c:9665'):
+        assert nodes.count(node) > 50
+
+
+def test_hash_ring_only_moves_targets_to_new_node():
+    ring = HashRing(['a:9665', 'b:9665', 'c:9665'])
+    bigger_ring = HashRing(['a:9665', 'b:9665', 'c:9665', 'd:9665'])
+    for i in range(300):
+        target = 'router{}'.format(i)
+        node = bigger_ring.get_node(target)
+        assert node == ring.get_node(target) or node == 'd:9665'
+
+
+def test_acquire_without_limits_does_not_touch_the_filesystem(tmp_path):
+    not_a_dir = tmp_path / 'file'
+    not_a_dir.write_text('')
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, {'lock_dir': str(not_a_dir / 'locks')})
+    assert slot.lock_files == []
+    controller.release(slot)
+
+
+def test_full_queue_rejects_lower_priority_newcomer(settings):
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, settings)
+    waiter = Scrape(controller, 'r1', 10, settings)
+    waiter.start()
+    wait_for(lambda: len(controller._waiting) == 1)
+
+    with pytest.raises(AdmissionError, match='queue is full'):
+        controller.acquire('r1', 5, settings)
+
+    controller.release(slot)
+    waiter.join()
+    assert waiter.slot is not None
+    controller.release(waiter.slot)
+    assert controller.rejected == 1
+
+
+def test_full_queue_evicts_lower_priority_waiter(settings):
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, settings)
+    low = Scrape(controller, 'r1', 0, settings)
+    low.start()
+    wait_for(lambda: len(controller._waiting) == 1)
+
+    high = Scrape(controller, 'r1', 100, settings)
+    high.start()
+    low.join()
+    assert 'Evicted' in str(low.error)
+
+    controller.release(slot)
+    high.join()
+    assert high.slot is not None
+    controller.release(high.slot)
+
+
+def test_higher_priority_waiter_is_admitted_first(settings):
+    settings['max_queue'] = 2
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, settings)
+    low = Scrape(controller, 'r1', 0, settings)
+    low.start()
+    wait_for(lambda: len(controller._waiting) == 1)
+    high = Scrape(controller, 'r1', 10, settings)
+    high.start()
+    wait_for(lambda: len(controller._waiting) == 2)
+
+    controller.release(slot)
+    high.join()
+    assert high.slot is not None
+    assert low.slot is None
+
+    controller.release(high.slot)
+    low.join()
+    assert low.slot is not None
+    controller.release(low.slot)
+
+
+def test_queue_timeout(settings):
+    settings['queue_timeout'] = 0.2
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, settings)
+
+    with pytest.raises(AdmissionError, match='Timed out waiting in the scrape queue'):
+        controller.acquire('r1', 0, settings)
+
+    assert controller._waiting == []
+    controller.release(slot)
+
+
+def test_other_targets_are_not_blocked(settings):
+    settings['max_concurrent'] = 2
+    controller = AdmissionController()
+    slot = controller.acquire('r1', 0, settings)
+    other = controller.acquire('r2', 0, settings)
+    controller.release(slot)
+    controller.release(other)
+
+
+def test_slot_held_by_another_worker(settings):
+    settings['queue_timeout'] = 0.3
+    os.makedirs(settings['lock_dir'])
+    target_hash = hashlib.sha1('r1'.encode('utf-8')).hexdigest()
+    with open(os.path.join(settings['lock_dir'], '{}.0.lock'.format(target_hash)), 'a') as other_worker:
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+        controller = AdmissionController()
+
+        with pytest.raises(AdmissionError, match='another worker'):
+            controller.acquire('r1', 0, settings)
+
+    # the worker local slot was given back
+    assert controller._active == 0
+    slot = controller.acquire('r1', 0, settings)
+    controller.release(slot)
+
+
+def test_unusable_lock_dir_releases_the_target(settings, tmp_path):
+    not_a_dir = tmp_path / 'file'
+    not_a_dir.write_text('')
+    settings['lock_dir'] = str(not_a_dir / 'locks')
+    controller = AdmissionController()
+
+    for _ in range(2):
+        with pytest.raises(AdmissionError, match='lock directory'):
+            controller.acquire('r1', 0, settings)
+
+    assert controller._active == 0
+    assert controller._active_targets == {}